@@ -26,14 +26,18 @@ from __future__ import absolute_import, print_function
 import subprocess
 
 from .. import display
+from .. import info
 from .. import osutils
 from .. import prefs
+from .. import utils
 
 from .. import FoundationPlist
 
 
+@utils.Memoize
 def filevault_is_active():
-    """Check if FileVault is enabled; returns True or False accordingly."""
+    """Check if FileVault is enabled; returns True or False accordingly.
+    Cached like supports_auth_restart()."""
     display.display_debug1('Checking if FileVault is enabled...')
     active_cmd = ['/usr/bin/fdesetup', 'isactive']
     try:
@@ -56,9 +60,14 @@ def filevault_is_active():
     return False
 
 
+@utils.Memoize
 def supports_auth_restart():
     """Checks if an Authorized Restart is supported; returns True
-    or False accordingly.
+    or False accordingly. fdesetup supportsauthrestart reports false when
+    FileVault is not enabled, so this also covers filevault_is_active(),
+    which is only consulted to decide how loudly to report a false answer.
+    The answer won't change during a munki run, so it is cached; long-running
+    callers should call clear_caches() between requests.
     """
     display.display_debug1(
         'Checking if FileVault can perform an AuthRestart...')
@@ -67,7 +76,9 @@ def supports_auth_restart():
         is_supported = subprocess.check_output(
             support_cmd, stderr=subprocess.STDOUT).decode('UTF-8')
     except subprocess.CalledProcessError as exc:
-        if exc.output:
+        if exc.output and 'false' in exc.output.decode('UTF-8'):
+            _report_auth_restart_unsupported()
+        elif exc.output:
             display.display_warning(exc.output)
         else:
             display.display_warning(
@@ -77,10 +88,20 @@ def supports_auth_restart():
         display.display_debug1('FileVault supports AuthRestart...')
         return True
 
-    display.display_warning('FileVault AuthRestart is not supported...')
+    _report_auth_restart_unsupported()
     return False
 
 
+def _report_auth_restart_unsupported():
+    """Reports that fdesetup says AuthRestart isn't supported. That's
+    expected when FileVault is off, so only warn if FileVault is on."""
+    if filevault_is_active():
+        display.display_warning('FileVault AuthRestart is not supported...')
+    else:
+        display.display_debug1(
+            'FileVault is disabled, so AuthRestart is not supported...')
+
+
 def is_fv_user(username):
     """Returns a boolean indicating if username is in the list of FileVault
     authorized users"""
@@ -104,10 +125,26 @@ def can_attempt_auth_restart_for(username):
     for us to attempt an authrestart with username's password'''
     os_version_tuple = osutils.getOsVersion(as_tuple=True)
     return (os_version_tuple >= (10, 8) and
-            prefs.pref('PerformAuthRestarts') and filevault_is_active() and
+            prefs.pref('PerformAuthRestarts') and
             supports_auth_restart() and is_fv_user(username))
 
 
+@utils.Memoize
+def _read_recovery_key_plist(recoverykeyplist):
+    """Reads and caches the plist at recoverykeyplist. Failed reads raise
+    and are not cached."""
+    return FoundationPlist.readPlist(recoverykeyplist)
+
+
+def clear_caches():
+    """Forgets cached fdesetup and RecoveryKeyFile results, so the next
+    check asks fdesetup and reads the key file again. For use by long-running
+    processes like authrestartd, where these can change between requests."""
+    filevault_is_active.clear()
+    supports_auth_restart.clear()
+    _read_recovery_key_plist.clear()
+
+
 def get_auth_restart_key(quiet=False):
     """Returns recovery key as a string... If we failed
     to get the proper information, returns an empty string.
@@ -123,7 +160,7 @@ def get_auth_restart_key(quiet=False):
             'RecoveryKeyFile preference is set to %s...', recoverykeyplist)
     # try to get the recovery key from the defined location
     try:
-        keyplist = FoundationPlist.readPlist(recoverykeyplist)
+        keyplist = _read_recovery_key_plist(recoverykeyplist)
         recovery_key = keyplist['RecoveryKey'].strip()
         return recovery_key
     except FoundationPlist.NSPropertyListSerializationException:
@@ -143,8 +180,7 @@ def can_attempt_auth_restart(have_password=False):
     for us to attempt an authrestart'''
     os_version_tuple = osutils.getOsVersion(as_tuple=True)
     return (os_version_tuple >= (10, 8) and
-            prefs.pref('PerformAuthRestarts') and
-            filevault_is_active() and supports_auth_restart() and
+            prefs.pref('PerformAuthRestarts') and supports_auth_restart() and
             (get_auth_restart_key(quiet=True) != '' or have_password))
 
 
@@ -179,13 +215,8 @@ def perform_auth_restart(username=None, password=None, delayminutes=0):
                '-delayminutes', str(delayminutes), '-inputplist']
     else:
         cmd = ['/usr/bin/fdesetup', 'authrestart', '-inputplist']
-    proc = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stdin=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    err = proc.communicate(input=inputplist)[1].decode('UTF-8')
+    proc = info.spawn(cmd)
+    err = proc.communicate(inputplist)[1].decode('UTF-8')
     if os_version_tuple >= (10, 12) and 'System is being restarted' in err:
         return True
     if err:
@@ -211,7 +242,7 @@ def do_authorized_or_normal_restart(username=None,
     if (prefs.pref('PerformAuthRestarts') and
             (prefs.pref('RecoveryKeyFile') or password) and
             os_version_tuple >= (10, 8)):
-        if filevault_is_active():
+        if supports_auth_restart():
             display.display_debug1('Configured to perform AuthRestarts...')
             # try to perform an auth restart
             if not perform_auth_restart(username=username, password=password):
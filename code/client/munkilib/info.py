@@ -23,14 +23,21 @@ Utilities that retrieve information from the current machine.
 from __future__ import absolute_import, print_function
 
 # standard libs
+import concurrent.futures
 import ctypes
 import ctypes.util
 import fcntl
+import functools
 import os
+import plistlib
 import select
+import selectors
 import struct
 import subprocess
 import sys
+import tempfile
+import time
+from collections.abc import Mapping
 
 # Apple's libs
 import objc
@@ -38,7 +45,7 @@ import LaunchServices
 # PyLint cannot properly find names inside Cocoa libraries, so issues bogus
 # No name 'Foo' in module 'Bar' warnings. Disable them.
 # pylint: disable=E0611
-from Foundation import NSMetadataQuery, NSPredicate, NSRunLoop
+from Foundation import NSPredicate
 from Foundation import NSBundle, NSDate, NSTimeZone
 # pylint: enable=E0611
 
@@ -51,19 +58,33 @@ from . import prefs
 from . import reports
 from . import utils
 from . import FoundationPlist
-from .wrappers import unicode_or_str
-
-try:
-    _ = xrange # pylint: disable=xrange-builtin
-except NameError:
-    # no xrange in Python 3
-    xrange = range # pylint: disable=redefined-builtin,invalid-name
+from .wrappers import readPlist, PlistReadError, unicode_or_str
 
 # Always ignore these directories when discovering applications.
-APP_DISCOVERY_EXCLUSION_DIRS = set([
+APP_DISCOVERY_EXCLUSION_DIRS = frozenset([
     'Volumes', 'tmp', '.vol', '.Trashes', '.MobileBackups', '.Spotlight-V100',
     '.fseventsd', 'Network', 'net', 'home', 'cores', 'dev', 'private',
     ])
+# the above as absolute paths, and as path prefixes so anything below them
+# can be checked with one startswith()
+_EXCLUSION_PATHS = frozenset(
+    '/%s' % item for item in APP_DISCOVERY_EXCLUSION_DIRS)
+_EXCLUSION_PREFIXES = tuple(
+    '/%s/' % item for item in APP_DISCOVERY_EXCLUSION_DIRS)
+
+# see man GETFSSTAT(2) for struct
+_STATFS32 = struct.Struct(b'=hh ll ll ll lQ lh hl 2l 15s 90s 90s x 16x')
+_STATFS64 = struct.Struct(b'=Ll QQ QQ Q ll l LLL 16s 1024s 1024s 32x')
+
+# mount flags we care about; see /usr/include/sys/mount.h
+MNT_RDONLY = 0x1
+MNT_LOCAL = 0x1000
+MNT_ROOTFS = 0x4000
+MNT_AUTOMOUNTED = 0x4000000
+_MNT_FLAGS_MASK = MNT_RDONLY | MNT_LOCAL | MNT_ROOTFS | MNT_AUTOMOUNTED
+
+# seconds before cached get_filesystems() results are considered stale
+FILESYSTEMS_TTL = 5.0
 
 
 class Error(Exception):
@@ -74,6 +95,10 @@ class TimeoutError(Error):
     """Timeout limit exceeded since last I/O."""
 
 
+class UnknownFilesystemError(Error):
+    """A path could not be matched to a mounted filesystem."""
+
+
 def set_file_nonblock(fileobj, non_blocking=True):
     """Set non-blocking flag on a file object.
 
@@ -90,41 +115,70 @@ def set_file_nonblock(fileobj, non_blocking=True):
 class Popen(subprocess.Popen):
     """Subclass of subprocess.Popen to add support for timeouts."""
 
+    def __init__(self, *args, **kwargs):
+        # bytes read past the end of a line by timed_readline, by fileno
+        self._readline_buffers = {}
+        super(Popen, self).__init__(*args, **kwargs)
+
     def timed_readline(self, fileobj, timeout):
         """Perform readline-like operation with timeout.
 
+        Reads from the underlying file descriptor in chunks; bytes past the
+        returned line are kept for the next call on the same fileobj.
+
         Args:
             fileobj: file object to .readline() on
             timeout: int, seconds of inactivity to raise error at
+        Returns:
+            bytes, the next line including its newline, or the remaining
+            output if EOF is reached first
         Raises:
             TimeoutError, if timeout is reached
         """
-        # pylint: disable=no-self-use
-        set_file_nonblock(fileobj)
-
-        output = []
-        inactive = 0
-        while True:
-            (rlist, dummy_wlist, dummy_xlist) = select.select(
-                [fileobj], [], [], 1.0)
-
-            if not rlist:
-                inactive += 1  # approx -- py select doesn't return tv
-                if inactive >= timeout:
-                    break
-            else:
+        fileno = fileobj.fileno()
+        buf = self._readline_buffers.setdefault(fileno, bytearray())
+
+        newline = buf.find(b'\n')
+        if newline == -1:
+            set_file_nonblock(fileobj)
+            inactive = 0
+            while True:
+                (rlist, dummy_wlist, dummy_xlist) = select.select(
+                    [fileobj], [], [], 1.0)
+
+                if not rlist:
+                    inactive += 1  # approx -- py select doesn't return tv
+                    if inactive >= timeout:
+                        break
+                    continue
                 inactive = 0
-                char = fileobj.read(1)
-                output.append(char)  # keep newline
-                if char == '' or char == '\n':
+                try:
+                    chunk = os.read(fileno, 4096)
+                except BlockingIOError:
+                    continue
+                if not chunk:
+                    # EOF
                     break
+                start = len(buf)
+                buf.extend(chunk)
+                newline = buf.find(b'\n', start)
+                if newline > -1:
+                    break
+
+            set_file_nonblock(fileobj, non_blocking=False)
 
-        set_file_nonblock(fileobj, non_blocking=False)
+            if inactive >= timeout:
+                # an incomplete line stays buffered for the next call
+                raise TimeoutError
 
-        if inactive >= timeout:
-            raise TimeoutError  # note, an incomplete line can be lost
+        if newline == -1:
+            # EOF; return whatever is left
+            line = bytes(buf)
+            del buf[:]
         else:
-            return ''.join(output)
+            line = bytes(buf[:newline + 1])  # keep newline
+            del buf[:newline + 1]
+        return line
 
     def communicate(self, std_in=None, timeout=0):
         """Communicate, optionally ending after a timeout of no activity.
@@ -141,16 +195,13 @@ class Popen(subprocess.Popen):
         if timeout <= 0:
             return super(Popen, self).communicate(input=std_in)
 
-        fds = []
-        stdout = []
-        stderr = []
-
-        if self.stdout is not None:
-            set_file_nonblock(self.stdout)
-            fds.append(self.stdout)
-        if self.stderr is not None:
-            set_file_nonblock(self.stderr)
-            fds.append(self.stderr)
+        output = {}
+        selector = selectors.DefaultSelector()
+        for fileobj in (self.stdout, self.stderr):
+            if fileobj is not None:
+                set_file_nonblock(fileobj)
+                output[fileobj] = bytearray()
+                selector.register(fileobj, selectors.EVENT_READ)
 
         if std_in is not None and sys.stdin is not None:
             try:
@@ -160,92 +211,94 @@ class Popen(subprocess.Popen):
                 # Python 2
                 sys.stdin.write(std_in)
 
-        returncode = None
-        inactive = 0
-        while returncode is None:
-            (rlist, dummy_wlist, dummy_xlist) = select.select(
-                fds, [], [], 1.0)
-
-            if not rlist:
-                inactive += 1
-                if inactive >= timeout:
-                    raise TimeoutError
-            else:
-                inactive = 0
-                for filedescr in rlist:
-                    if filedescr is self.stdout:
-                        stdout.append(filedescr.read())
-                    elif filedescr is self.stderr:
-                        stderr.append(filedescr.read())
-
-            returncode = self.poll()
+        deadline = time.monotonic() + timeout
+        try:
+            while selector.get_map():
+                events = selector.select(
+                    timeout=max(deadline - time.monotonic(), 0))
+                if not events:
+                    if self.poll() is not None:
+                        # process is gone and there's nothing left to read
+                        break
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError
+                    continue
+                # timeout is for inactivity, so reset it on any output
+                deadline = time.monotonic() + timeout
+                for key, dummy_mask in events:
+                    try:
+                        chunk = os.read(key.fd, 65536)
+                    except BlockingIOError:
+                        continue
+                    if chunk:
+                        output[key.fileobj].extend(chunk)
+                    else:
+                        # EOF
+                        selector.unregister(key.fileobj)
+            # all output read; wait out the remaining time for exit
+            self.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            raise TimeoutError
+        finally:
+            selector.close()
 
         if self.stdout is not None:
-            stdout_str = b''.join(stdout)
+            stdout_str = bytes(output[self.stdout])
         else:
             stdout_str = None
         if self.stderr is not None:
-            stderr_str = b''.join(stderr)
+            stderr_str = bytes(output[self.stderr])
         else:
             stderr_str = None
 
         return (stdout_str, stderr_str)
 
 
-def _unsigned(i):
-    """Translate a signed int into an unsigned int.  Int type returned
-    is longer than the original since Python has no unsigned int."""
-    return i & 0xFFFFFFFF
+def spawn(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE):
+    """Starts cmd with stdout connected to a pipe.
 
+    Pipes are buffered in 64KB chunks to match what we read at a time, and
+    the child does not inherit our other open file descriptors.
 
-def _asciiz_to_bytestr(a_bytestring):
-    """Transform a null-terminated string of any length into a Python str.
-    Returns a normal Python str that has been terminated.
+    Args:
+      cmd: list, command and arguments
+      stdin: optional, what to connect to the child's stdin; a pipe by
+             default, or e.g. the stdout of another process
+      stderr: optional, what to connect to the child's stderr; a pipe by
+              default
+    Returns:
+      Popen object (ours, so communicate() can be given a timeout)
     """
-    i = a_bytestring.find(b'\0')
-    if i > -1:
-        a_bytestring = a_bytestring[0:i]
-    return a_bytestring
+    return Popen(cmd, shell=False, bufsize=65536, close_fds=True,
+                 stdin=stdin, stdout=subprocess.PIPE, stderr=stderr)
 
 
-def _f_flags_to_set(f_flags):
-    """Transform an int f_flags parameter into a set of mount options.
-    Returns a set.
+def _asciiz_to_bytestr(a_bytestring):
+    """Transform a null-terminated string of any length into a Python str.
+    Returns a normal Python str that has been terminated.
     """
-    # see /usr/include/sys/mount.h for the bitmask constants.
-    flags = set()
-    if f_flags & 0x1:
-        flags.add('read-only')
-    if f_flags & 0x1000:
-        flags.add('local')
-    if f_flags & 0x4000:
-        flags.add('rootfs')
-    if f_flags & 0x4000000:
-        flags.add('automounted')
-    return flags
+    return a_bytestring.partition(b'\0')[0]
 
 
 def get_filesystems():
     """Get a list of all mounted filesystems on this system.
 
     Return value is dict, e.g. {
-        int st_dev: {
+        (int f_fsid_0, int f_fsid_1): {
+            'f_flags': MNT_AUTOMOUNTED,
             'f_fstypename': 'nfs',
             'f_mntonname': '/mountedpath',
             'f_mntfromname': 'homenfs:/path',
         },
     }
 
-    Note: st_dev values are static for potentially only one boot, but
-    static for multiple mount instances.
+    Keys come straight from the statfs structs, so no mount point needs to
+    be stat()ed here. See _filesystems_by_dev() for st_dev keys.
     """
 
     mnt_nowait = 2
 
     libc = ctypes.cdll.LoadLibrary(ctypes.util.find_library("c"))
-    # see man GETFSSTAT(2) for struct
-    statfs_32_struct = b'=hh ll ll ll lQ lh hl 2l 15s 90s 90s x 16x'
-    statfs_64_struct = b'=Ll QQ QQ Q ll l LLL 16s 1024s 1024s 32x'
     os_version = osutils.getOsVersion(as_tuple=True)
     if os_version <= (10, 5):
         mode = 32
@@ -253,12 +306,11 @@ def get_filesystems():
         mode = 64
 
     if mode == 64:
-        statfs_struct = statfs_64_struct
+        statfs_struct = _STATFS64
     else:
-        statfs_struct = statfs_32_struct
+        statfs_struct = _STATFS32
 
-    sizeof_statfs_struct = struct.calcsize(statfs_struct)
-    bufsize = 30 * sizeof_statfs_struct  # only supports 30 mounted fs
+    bufsize = 30 * statfs_struct.size  # only supports 30 mounted fs
     buf = ctypes.create_string_buffer(bufsize)
 
     if mode == 64:
@@ -273,43 +325,93 @@ def get_filesystems():
         display.display_debug1('getfsstat() returned errno %d' % no_of_structs)
         return {}
 
-    ofs = 0
     output = {}
+    # unpack directly from the ctypes buffer; no per-struct slice copies
+    structs = memoryview(buf)[:no_of_structs * statfs_struct.size]
     # struct_unpack returns lots of values, but we use only a few
     # pylint: disable=unused-variable
-    for i in xrange(0, no_of_structs):
+    for values in statfs_struct.iter_unpack(structs):
         if mode == 64:
             (f_bsize, f_iosize, f_blocks, f_bfree, f_bavail, f_files,
              f_ffree, f_fsid_0, f_fsid_1, f_owner, f_type, f_flags,
              f_fssubtype,
-             f_fstypename, f_mntonname, f_mntfromname) = struct.unpack(
-                 statfs_struct, bytes(buf[ofs:ofs+sizeof_statfs_struct]))
+             f_fstypename, f_mntonname, f_mntfromname) = values
         elif mode == 32:
             (f_otype, f_oflags, f_bsize, f_iosize, f_blocks, f_bfree, f_bavail,
              f_files, f_ffree, f_fsid, f_owner, f_reserved1, f_type, f_flags,
              f_reserved2_0, f_reserved2_1, f_fstypename, f_mntonname,
-             f_mntfromname) = struct.unpack(
-                 statfs_struct, bytes(buf[ofs:ofs+sizeof_statfs_struct]))
+             f_mntfromname) = values
+
+        if mode == 32:
+            f_fsid_0, f_fsid_1 = f_fsid, f_fsid >> 32
+
+        # fsid values are unpacked signed; key on them as unsigned ints
+        output[(f_fsid_0 & 0xFFFFFFFF, f_fsid_1 & 0xFFFFFFFF)] = {
+            'f_flags': f_flags & _MNT_FLAGS_MASK,
+            'f_fstypename': _asciiz_to_bytestr(f_fstypename),
+            'f_mntonname': _asciiz_to_bytestr(f_mntonname),
+            'f_mntfromname': _asciiz_to_bytestr(f_mntfromname),
+        }
+    # pylint: enable=unused-variable
+
+    return output
+
 
+def _filesystems_by_dev(filesystems):
+    """Re-keys a get_filesystems() result by st_dev, which is what os.stat()
+    gives us for a path. Each unique mount point is stat()ed only once.
+
+    Note: st_dev values are static for potentially only one boot, but
+    static for multiple mount instances.
+    """
+    output = {}
+    seen_mountpoints = set()
+    # with stacked mounts, the last one listed is on top and is what
+    # stat() of the mount point reports
+    for info in reversed(list(filesystems.values())):
+        if info['f_mntonname'] in seen_mountpoints:
+            continue
+        seen_mountpoints.add(info['f_mntonname'])
         try:
-            stat_val = os.stat(_asciiz_to_bytestr(f_mntonname))
-            output[stat_val.st_dev] = {
-                'f_flags_set': _f_flags_to_set(f_flags),
-                'f_fstypename': _asciiz_to_bytestr(f_fstypename),
-                'f_mntonname': _asciiz_to_bytestr(f_mntonname),
-                'f_mntfromname': _asciiz_to_bytestr(f_mntfromname),
-            }
+            output[os.stat(info['f_mntonname']).st_dev] = info
         except OSError:
             pass
+    return output
 
-        ofs += sizeof_statfs_struct
-    # pylint: enable=unused-variable
 
-    return output
+def _path_st_dev(path):
+    """Returns the st_dev of path, or None if it can't be stat()ed."""
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+# (time.monotonic() timestamp, _filesystems_by_dev() result)
+FILESYSTEMS = (0, {})
+# st_dev values of NFS filesystems and of read-only or non-local filesystems
+_NFS_DEVS = frozenset()
+_EXCLUDED_FLAGS_DEVS = frozenset()
+# st_dev values still missing from FILESYSTEMS after a refresh
+_UNMATCHED_DEVS = set()
+
+
+def _refresh_filesystems():
+    """Refreshes FILESYSTEMS and the st_dev sets derived from it."""
+    global FILESYSTEMS, _NFS_DEVS, _EXCLUDED_FLAGS_DEVS
 
+    filesystems = _filesystems_by_dev(get_filesystems())
+    FILESYSTEMS = (time.monotonic(), filesystems)
+    _NFS_DEVS = frozenset(
+        st_dev for st_dev, info in filesystems.items()
+        if info['f_fstypename'] == b'nfs')
+    _EXCLUDED_FLAGS_DEVS = frozenset(
+        st_dev for st_dev, info in filesystems.items()
+        if info['f_flags'] & MNT_RDONLY or
+        not info['f_flags'] & MNT_LOCAL)
 
-FILESYSTEMS = {}
-def is_excluded_filesystem(path, _retry=False):
+
+def is_excluded_filesystem(path):
     """Gets filesystem information for a path and determine if it should be
     excluded from application searches.
 
@@ -318,40 +420,57 @@ def is_excluded_filesystem(path, _retry=False):
     Returns False if none of these conditions are true.
     Returns None if it cannot be determined.
     """
-    global FILESYSTEMS
-
     if not path:
         return None
 
-    path_components = path.split('/')
-    if len(path_components) > 1:
-        if path_components[1] in APP_DISCOVERY_EXCLUSION_DIRS:
-            return True
-
-    if not FILESYSTEMS or _retry:
-        FILESYSTEMS = get_filesystems()
+    if path in _EXCLUSION_PATHS or path.startswith(_EXCLUSION_PREFIXES):
+        return True
 
     try:
-        stat_val = os.stat(path)
-    except OSError:
-        stat_val = None
-
-    if stat_val is None or stat_val.st_dev not in FILESYSTEMS:
-        if not _retry:
-            # perhaps the stat() on the path caused autofs to mount
-            # the required filesystem and now it will be available.
-            # try one more time to look for it after flushing the cache.
-            display.display_debug1(
-                'Trying isExcludedFilesystem again for %s' % path)
-            return is_excluded_filesystem(path, True)
-        # _retry defined
+        return _is_excluded_realpath(os.path.realpath(path))
+    except UnknownFilesystemError:
         display.display_debug1(
             'Could not match path %s to a filesystem' % path)
         return None
 
-    exc_flags = ('read-only' in FILESYSTEMS[stat_val.st_dev]['f_flags_set'] or
-                 'local' not in FILESYSTEMS[stat_val.st_dev]['f_flags_set'])
-    is_nfs = FILESYSTEMS[stat_val.st_dev]['f_fstypename'] == 'nfs'
+
+@functools.lru_cache(maxsize=4096)
+def _is_excluded_realpath(path):
+    """Does the filesystem checks for is_excluded_filesystem() on a fully
+    resolved path. Cached, since app discovery checks the same paths (and
+    paths on the same few filesystems) many times over.
+
+    Raises UnknownFilesystemError rather than returning an undetermined
+    result, so that result is not cached; the filesystem may be mounted
+    by the time the path is checked again."""
+    timestamp, filesystems = FILESYSTEMS
+    if not filesystems or time.monotonic() - timestamp > FILESYSTEMS_TTL:
+        _refresh_filesystems()
+        _UNMATCHED_DEVS.clear()
+
+    st_dev = _path_st_dev(path)
+    if st_dev is None:
+        # a path we can't stat() can't be matched, no matter how fresh
+        # the filesystem info is
+        raise UnknownFilesystemError(path)
+    if st_dev not in FILESYSTEMS[1]:
+        if st_dev in _UNMATCHED_DEVS:
+            # we already refreshed after this filesystem was mounted
+            raise UnknownFilesystemError(path)
+        # perhaps the stat() on the path caused autofs to mount
+        # the required filesystem and now it will be available.
+        # try one more time to look for it after refreshing the cache.
+        display.display_debug1(
+            'Trying isExcludedFilesystem again for %s' % path)
+        _refresh_filesystems()
+        if st_dev not in FILESYSTEMS[1]:
+            _UNMATCHED_DEVS.add(st_dev)
+        st_dev = _path_st_dev(path)
+        if st_dev is None or st_dev not in FILESYSTEMS[1]:
+            raise UnknownFilesystemError(path)
+
+    exc_flags = st_dev in _EXCLUDED_FLAGS_DEVS
+    is_nfs = st_dev in _NFS_DEVS
 
     if is_nfs or exc_flags:
         display.display_debug1(
@@ -361,73 +480,60 @@ def is_excluded_filesystem(path, _retry=False):
 
 
 def find_apps_in_dirs(dirlist):
-    """Do spotlight search for type applications within the
-    list of directories provided. Returns a list of paths to applications
-    these appear to always be some form of unicode string.
+    """Formerly did a Spotlight search for applications within the list of
+    directories provided. Application discovery now uses LaunchServices and
+    filesystem_installed_apps(), so this always returns an empty list.
+    Kept for compatibility with callers outside munkilib.
     """
-    applist = []
-    query = NSMetadataQuery.alloc().init()
-    query.setPredicate_(
-        NSPredicate.predicateWithFormat_('(kMDItemKind = "Application")'))
-    query.setSearchScopes_(dirlist)
-    query.startQuery()
-    # Spotlight isGathering phase - this is the initial search. After the
-    # isGathering phase Spotlight keeps running returning live results from
-    # filesystem changes, we are not interested in that phase.
-    # Run for 0.3 seconds then check if isGathering has completed.
-    runtime = 0
-    maxruntime = 20
-    while query.isGathering() and runtime <= maxruntime:
-        runtime += 0.3
-        NSRunLoop.currentRunLoop(
-            ).runUntilDate_(NSDate.dateWithTimeIntervalSinceNow_(0.3))
-    query.stopQuery()
-
-    if runtime >= maxruntime:
-        display.display_warning(
-            'Spotlight search for applications terminated due to excessive '
-            'time. Possible causes: Spotlight indexing is turned off for a '
-            'volume; Spotlight is reindexing a volume.')
+    # pylint: disable=unused-argument
+    return []
 
-    for item in query.results():
-        pathname = item.valueForAttribute_('kMDItemPath')
-        if pathname and not is_excluded_filesystem(pathname):
-            applist.append(pathname)
 
+def _find_apps_in_dir(dirpath, recursive=True):
+    """Returns paths of application bundles in dirpath, and if recursive, in
+    its subdirectories. Doesn't descend into application bundles, hidden
+    directories, or symlinked directories."""
+    applist = []
+    dirs_to_scan = [dirpath]
+    while dirs_to_scan:
+        try:
+            with os.scandir(dirs_to_scan.pop()) as entries:
+                for entry in entries:
+                    if (entry.name.startswith('.') or
+                            not entry.is_dir(follow_symlinks=False)):
+                        continue
+                    if entry.name.endswith('.app'):
+                        applist.append(entry.path)
+                    elif recursive:
+                        dirs_to_scan.append(entry.path)
+        except OSError:
+            # directory doesn't exist or isn't readable
+            continue
     return applist
 
 
-def spotlight_installed_apps():
-    """Get paths of currently installed applications per Spotlight.
+def filesystem_installed_apps():
+    """Get paths of applications installed at the top level of /, and
+    anywhere within /Applications, /Users/Shared and each user's
+    ~/Applications.
     Return value is list of paths.
-    Excludes most non-boot volumes.
-    In future may include local r/w volumes.
+    Excludes apps on excluded filesystems.
     """
-    dirlist = []
-    applist = []
+    applist = _find_apps_in_dir(u'/', recursive=False)
+    dirlist = [u'/Applications', u'/Users/Shared']
+    try:
+        with os.scandir(u'/Users') as entries:
+            for entry in entries:
+                if (entry.name != u'Shared' and
+                        entry.is_dir(follow_symlinks=False)):
+                    dirlist.append(
+                        os.path.join(entry.path, u'Applications'))
+    except OSError:
+        pass
+    for dirpath in dirlist:
+        applist.extend(_find_apps_in_dir(dirpath))
 
-    for filename in osutils.listdir(u'/'):
-        pathname = os.path.join(u'/', filename)
-        if (os.path.isdir(pathname) and not os.path.islink(pathname) and
-                not is_excluded_filesystem(pathname)):
-            if filename.endswith('.app'):
-                applist.append(pathname)
-            else:
-                dirlist.append(pathname)
-
-    # Future code changes may mean we wish to look for Applications
-    # installed on any r/w local volume.
-    #for f in osutils.listdir(u'/Volumes'):
-    #    p = os.path.join(u'/Volumes', f)
-    #    if os.path.isdir(p) and not os.path.islink(p) \
-    #                        and not is_excluded_filesystem(p):
-    #        dirlist.append(p)
-
-    # /Users is not currently excluded, so no need to add /Users/Shared.
-    #dirlist.append(u'/Users/Shared')
-
-    applist.extend(find_apps_in_dirs(dirlist))
-    return applist
+    return [app for app in applist if not is_excluded_filesystem(app)]
 
 
 def launchservices_installed_apps():
@@ -445,8 +551,8 @@ def launchservices_installed_apps():
     applist = []
     for app in apps:
         app_path = app.path()
-        if (app_path and not is_excluded_filesystem(app_path) and
-                os.path.exists(app_path)):
+        if (app_path and os.path.exists(app_path) and
+                not is_excluded_filesystem(app_path)):
             applist.append(app_path)
 
     return applist
@@ -456,20 +562,33 @@ def launchservices_installed_apps():
 def sp_application_data():
     '''Uses system profiler to get application info for this machine'''
     cmd = ['/usr/sbin/system_profiler', 'SPApplicationsDataType', '-xml']
+    # this output can be several MB, so have plutil convert it to a binary
+    # plist, which is smaller and much quicker for plistlib to parse
+    sp_proc = spawn(cmd, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     # uses our internal Popen instead of subprocess's so we can timeout
-    proc = Popen(cmd, shell=False, bufsize=-1,
-                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                 stderr=subprocess.PIPE)
+    proc = spawn(['/usr/bin/plutil', '-convert', 'binary1', '-o', '-', '-'],
+                 stdin=sp_proc.stdout)
+    # plutil owns the pipe now; if it exits, system_profiler gets SIGPIPE
+    sp_proc.stdout.close()
     try:
+        # plutil writes nothing until system_profiler closes its end of the
+        # pipe, so this inactivity timeout bounds system_profiler's whole
+        # run. That's no change: system_profiler -xml also only writes once
+        # it has gathered everything.
         output, dummy_error = proc.communicate(timeout=60)
     except TimeoutError:
         display.display_error(
             'system_profiler hung; skipping SPApplicationsDataType query')
+        for stage in (proc, sp_proc):
+            stage.kill()
+            stage.wait()
         # return empty dict
         return {}
+    sp_proc.wait()
     try:
-        plist = FoundationPlist.readPlistFromString(output)
-        # system_profiler xml is an array
+        # plistlib parses natively, no per-node PyObjC bridging
+        plist = plistlib.loads(output)
+        # system_profiler output is an array
         application_data = {}
         for item in plist[0]['_items']:
             application_data[item.get('path')] = item
@@ -478,6 +597,92 @@ def sp_application_data():
     return application_data
 
 
+def _appinfo_cache_path():
+    """Returns the path to the app info cache."""
+    return os.path.join(
+        prefs.pref('ManagedInstallDir'), 'Caches', 'AppInfoCache.plist')
+
+
+# keys every app info cache entry must have
+_APPINFO_CACHE_KEYS = ('mtime_ns', 'name', 'bundleid', 'version')
+
+
+def _load_appinfo_cache():
+    """Returns app info saved by an earlier run, as a dict keyed by app path.
+    Each value is a dict with name, bundleid, version and the mtime_ns of the
+    app's Info.plist when that info was read."""
+    cachepath = _appinfo_cache_path()
+    if not os.path.exists(cachepath):
+        return {}
+    try:
+        # plistlib gives us plain dicts and strs, so the cache can be
+        # compared with the next one and skip an unneeded write
+        cached_plist = readPlist(cachepath)
+    except PlistReadError as err:
+        display.display_debug1(
+            'Could not read app info cache %s: %s', cachepath, err)
+        return {}
+    if not isinstance(cached_plist, Mapping):
+        display.display_debug1(
+            'Ignoring malformed app info cache %s', cachepath)
+        return {}
+    # keep only well-formed entries, so workers can trust what they get
+    appinfo_cache = {}
+    for pathname, entry in cached_plist.items():
+        if (isinstance(entry, Mapping) and
+                all(key in entry for key in _APPINFO_CACHE_KEYS)):
+            appinfo_cache[pathname] = entry
+    return appinfo_cache
+
+
+def _save_appinfo_cache(appinfo_cache):
+    """Saves app info for use by the next run"""
+    cachepath = _appinfo_cache_path()
+    try:
+        cachedir = os.path.dirname(cachepath)
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        _write_binary_plist(appinfo_cache, cachepath)
+    except (OSError, TypeError, OverflowError, ValueError) as err:
+        display.display_debug1(
+            'Could not save app info cache %s: %s', cachepath, err)
+
+
+def _bundle_app_info(pathname, appinfo_cache):
+    """Gets name, version and bundleid for the app bundle at pathname.
+    Uses the entry in appinfo_cache instead if the app's Info.plist hasn't
+    been modified since it was cached.
+
+    Returns a tuple of (iteminfo, mtime_ns). iteminfo is a dict, an empty
+    dict if pathname has no Info.plist (possibly a non-bundle app), or None
+    if the Info.plist could not be read. mtime_ns is the Info.plist's
+    modification time, or None if it doesn't exist.
+    Called from worker threads, so must not touch shared state."""
+    plistpath = os.path.join(pathname, 'Contents', 'Info.plist')
+    try:
+        mtime_ns = os.stat(plistpath).st_mtime_ns
+    except OSError:
+        return {}, None
+    iteminfo = {}
+    iteminfo['name'] = os.path.splitext(os.path.basename(pathname))[0]
+    iteminfo['path'] = pathname
+    cached = appinfo_cache.get(pathname)
+    if cached and cached['mtime_ns'] == mtime_ns:
+        iteminfo['bundleid'] = cached['bundleid']
+        iteminfo['name'] = cached['name']
+        iteminfo['version'] = cached['version']
+        return iteminfo, mtime_ns
+    try:
+        plist = FoundationPlist.readPlist(plistpath)
+        iteminfo['bundleid'] = plist.get('CFBundleIdentifier', '')
+        if 'CFBundleName' in plist:
+            iteminfo['name'] = plist['CFBundleName']
+        iteminfo['version'] = pkgutils.getBundleVersion(pathname)
+    except BaseException:
+        return None, mtime_ns
+    return iteminfo, mtime_ns
+
+
 @utils.Memoize
 def app_data():
     """Gets info on currently installed apps.
@@ -485,34 +690,55 @@ def app_data():
     application_data = []
     display.display_debug1(
         'Getting info on currently installed applications...')
-    applist = set(launchservices_installed_apps())
-    applist.update(spotlight_installed_apps())
-    for pathname in applist:
-        iteminfo = {}
-        iteminfo['name'] = os.path.splitext(os.path.basename(pathname))[0]
-        iteminfo['path'] = pathname
-        plistpath = os.path.join(pathname, 'Contents', 'Info.plist')
-        if os.path.exists(plistpath):
-            try:
-                plist = FoundationPlist.readPlist(plistpath)
-                iteminfo['bundleid'] = plist.get('CFBundleIdentifier', '')
-                if 'CFBundleName' in plist:
-                    iteminfo['name'] = plist['CFBundleName']
-                iteminfo['version'] = pkgutils.getBundleVersion(pathname)
-                application_data.append(iteminfo)
-            except BaseException:
-                pass
-        else:
+    appinfo_cache = _load_appinfo_cache()
+    new_appinfo_cache = {}
+    sp_app_data = None
+    # Info.plist reads are I/O bound, so overlap them across worker threads
+    max_workers = (os.cpu_count() or 1) * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        # LaunchServices and the directory scan can report the same app under
+        # different paths (via symlinks, or differing only in case), so dedupe
+        # on the resolved path, keeping the first path reported.
+        # Reads for LaunchServices' apps are queued before the directory
+        # scan starts, so the workers process them while the scan runs.
+        unique_apps = {}
+        for app_source in (launchservices_installed_apps,
+                           filesystem_installed_apps):
+            for pathname in app_source():
+                key = os.path.realpath(pathname).lower()
+                if key not in unique_apps:
+                    unique_apps[key] = (pathname, executor.submit(
+                        _bundle_app_info, pathname, appinfo_cache))
+        results = [(pathname, future.result())
+                   for pathname, future in unique_apps.values()]
+    for pathname, (iteminfo, mtime_ns) in results:
+        if iteminfo:
+            application_data.append(iteminfo)
+            new_appinfo_cache[pathname] = {
+                'mtime_ns': mtime_ns,
+                'name': unicode_or_str(iteminfo['name']),
+                'bundleid': unicode_or_str(iteminfo['bundleid']),
+                'version': unicode_or_str(iteminfo['version']),
+            }
+        elif iteminfo is not None:
             # possibly a non-bundle app. Use system_profiler data
-            # to get app name and version
-            sp_app_data = sp_application_data()
-            if pathname in sp_app_data:
-                item = sp_app_data[pathname]
+            # to get app name and version. Fetched only on first need,
+            # since system_profiler is slow
+            if sp_app_data is None:
+                sp_app_data = sp_application_data()
+            item = sp_app_data.get(pathname)
+            if item is not None:
+                iteminfo['name'] = os.path.splitext(
+                    os.path.basename(pathname))[0]
+                iteminfo['path'] = pathname
                 iteminfo['bundleid'] = ''
                 iteminfo['version'] = item.get('version') or '0.0.0.0.0'
                 if item.get('_name'):
                     iteminfo['name'] = item['_name']
                 application_data.append(iteminfo)
+    # most runs find nothing new, so don't rewrite the cache every time
+    if new_appinfo_cache != appinfo_cache:
+        _save_appinfo_cache(new_appinfo_cache)
     return application_data
 
 
@@ -549,22 +775,32 @@ def get_version():
     return vers
 
 
-def get_sp_data(data_type):
-    '''Uses system profiler to get info of data_type for this machine'''
-    cmd = ['/usr/sbin/system_profiler', data_type, '-xml']
-    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def _sp_batch(*data_types):
+    '''Uses a single system_profiler call to get info of all data_types for
+    this machine. Returns a dict mapping each data type to its list of items;
+    the list is empty if system_profiler returned nothing for that type.'''
+    sp_items = dict((data_type, []) for data_type in data_types)
+    cmd = ['/usr/sbin/system_profiler'] + list(data_types) + ['-xml']
+    proc = spawn(cmd)
     output = proc.communicate()[0]
     try:
-        plist = FoundationPlist.readPlistFromString(output)
-        # system_profiler xml is an array
-        sp_dict = plist[0]
-        items = sp_dict['_items']
-        sp_items_dict = items[0]
-        return sp_items_dict
+        plist = plistlib.loads(output)
+        # system_profiler xml is an array, with a dict per data type
+        for sp_dict in plist:
+            if sp_dict.get('_dataType') in sp_items:
+                sp_items[sp_dict['_dataType']] = sp_dict.get('_items', [])
     except BaseException:
-        return {}
+        # something is wrong with system_profiler output
+        pass
+    return sp_items
+
+
+def get_sp_data(data_type):
+    '''Uses system profiler to get info of data_type for this machine'''
+    items = _sp_batch(data_type)[data_type]
+    if items:
+        return items[0]
+    return {}
 
 
 def get_hardware_info():
@@ -577,25 +813,10 @@ def get_ibridge_info():
     return get_sp_data('SPiBridgeDataType')
 
 
-def get_ip_addresses(kind):
-    '''Uses system profiler to get active IP addresses for this machine
-    kind must be one of 'IPv4' or 'IPv6' '''
+def _ip_addresses_from_sp_items(items, kind):
+    '''Returns active IP addresses of kind ('IPv4' or 'IPv6') from
+    SPNetworkDataType items'''
     ip_addresses = []
-    cmd = ['/usr/sbin/system_profiler', 'SPNetworkDataType', '-xml']
-    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output = proc.communicate()[0]
-    try:
-        plist = FoundationPlist.readPlistFromString(output)
-        # system_profiler xml is an array of length 1
-        sp_dict = plist[0]
-        items = sp_dict['_items']
-    except BaseException:
-        # something is wrong with system_profiler output
-        # so bail
-        return ip_addresses
-
     for item in items:
         try:
             ip_addresses.extend(item[kind]['Addresses'])
@@ -606,6 +827,13 @@ def get_ip_addresses(kind):
     return ip_addresses
 
 
+def get_ip_addresses(kind):
+    '''Uses system profiler to get active IP addresses for this machine
+    kind must be one of 'IPv4' or 'IPv6' '''
+    return _ip_addresses_from_sp_items(
+        _sp_batch('SPNetworkDataType')['SPNetworkDataType'], kind)
+
+
 def get_serial_number():
     """Returns the serial number of this Mac _without_ calling system_profiler."""
     # Borrowed with love from
@@ -714,10 +942,15 @@ def getMachineFacts():
     machine['os_build_number'] = get_os_build()
     machine['machine_model'] = hardware_model() or 'UNKNOWN'
     machine['munki_version'] = get_version()
-    machine['ipv4_address'] = get_ip_addresses('IPv4')
-    machine['ipv6_address'] = get_ip_addresses('IPv6')
+    # one system_profiler run for everything we need from it
+    sp_items = _sp_batch('SPNetworkDataType', 'SPiBridgeDataType')
+    machine['ipv4_address'] = _ip_addresses_from_sp_items(
+        sp_items['SPNetworkDataType'], 'IPv4')
+    machine['ipv6_address'] = _ip_addresses_from_sp_items(
+        sp_items['SPNetworkDataType'], 'IPv6')
     machine['serial_number'] = get_serial_number() or 'UNKNOWN'
-    ibridge_info = get_ibridge_info()
+    ibridge_items = sp_items['SPiBridgeDataType']
+    ibridge_info = ibridge_items[0] if ibridge_items else {}
     machine['ibridge_model_name'] = ibridge_info.get(
         'ibridge_model_name', 'NO IBRIDGE CHIP')
     if machine['arch'] == 'x86_64':
@@ -750,27 +983,26 @@ def get_conditions():
         os.unlink(conditionalitemspath)
     except (OSError, IOError):
         pass
-    if os.path.exists(conditionalscriptdir):
-        for conditionalscript in sorted(osutils.listdir(conditionalscriptdir)):
-            if conditionalscript.startswith('.'):
-                # skip files that start with a period
-                continue
-            conditionalscriptpath = os.path.join(
-                conditionalscriptdir, conditionalscript)
-            if os.path.isdir(conditionalscriptpath):
-                # skip directories in conditions directory
-                continue
-            try:
-                # attempt to execute condition script
-                dummy_result, dummy_stdout, dummy_stderr = (
-                    utils.runExternalScript(conditionalscriptpath))
-            except utils.ScriptNotFoundError:
-                pass  # script is not required, so pass
-            except utils.RunExternalScriptError as err:
-                print(unicode_or_str(err), file=sys.stderr)
-    else:
+    try:
+        # scandir gives us the file type from the directory listing itself,
+        # so there's no extra stat() per entry
+        with os.scandir(conditionalscriptdir) as entries:
+            conditionalscripts = sorted(
+                entry.path for entry in entries
+                # skip files that start with a period and directories
+                if not entry.name.startswith('.') and not entry.is_dir())
+    except OSError:
         # /usr/local/munki/conditions does not exist
-        pass
+        conditionalscripts = []
+    for conditionalscriptpath in conditionalscripts:
+        try:
+            # attempt to execute condition script
+            dummy_result, dummy_stdout, dummy_stderr = (
+                utils.runExternalScript(conditionalscriptpath))
+        except utils.ScriptNotFoundError:
+            pass  # script is not required, so pass
+        except utils.RunExternalScriptError as err:
+            print(unicode_or_str(err), file=sys.stderr)
     if (os.path.exists(conditionalitemspath) and
             valid_plist(conditionalitemspath)):
         # import conditions into conditions dict
@@ -788,27 +1020,55 @@ def saveappdata():
     # data from app_data() is meant for use by updatecheck
     # we need to massage it a bit for more general usage
     munkilog.log('Saving application inventory...')
+    def as_str(value):
+        """plistlib can't serialize PyObjC/NS types or None, so hand it
+        plain strs"""
+        if value is None:
+            return ''
+        return unicode_or_str(value)
+
     app_inventory = []
     for item in app_data():
         inventory_item = {}
-        inventory_item['CFBundleName'] = item.get('name')
-        inventory_item['bundleid'] = item.get('bundleid')
-        inventory_item['version'] = item.get('version')
-        inventory_item['path'] = item.get('path', '')
+        inventory_item['CFBundleName'] = as_str(item.get('name'))
+        inventory_item['bundleid'] = as_str(item.get('bundleid'))
+        inventory_item['version'] = as_str(item.get('version'))
+        inventory_item['path'] = as_str(item.get('path'))
         # use last path item (minus '.app' if present) as name
         inventory_item['name'] = \
             os.path.splitext(os.path.basename(inventory_item['path']))[0]
         app_inventory.append(inventory_item)
+    inventorypath = os.path.join(
+        prefs.pref('ManagedInstallDir'), 'ApplicationInventory.plist')
     try:
-        FoundationPlist.writePlist(
-            app_inventory,
-            os.path.join(
-                prefs.pref('ManagedInstallDir'), 'ApplicationInventory.plist'))
-    except FoundationPlist.NSPropertyListSerializationException as err:
+        _write_binary_plist(app_inventory, inventorypath)
+    except (OSError, TypeError, OverflowError, ValueError) as err:
         display.display_warning(
             'Unable to save inventory report: %s' % err)
 
 
+def _write_binary_plist(data, filepath):
+    """Writes data to filepath as a binary plist, which is smaller and faster
+    to write and re-read than XML. Writes to a temp file and renames it into
+    place so readers never see a partial file.
+    Raises OSError, or TypeError/OverflowError/ValueError if plistlib can't
+    serialize data."""
+    tempfd, temppath = tempfile.mkstemp(
+        prefix='.' + os.path.splitext(os.path.basename(filepath))[0],
+        dir=os.path.dirname(filepath))
+    try:
+        with os.fdopen(tempfd, 'wb') as fileobj:
+            plistlib.dump(data, fileobj, fmt=plistlib.FMT_BINARY)
+        os.chmod(temppath, 0o644)
+        os.rename(temppath, filepath)
+    except BaseException:
+        try:
+            os.unlink(temppath)
+        except OSError:
+            pass
+        raise
+
+
 # conditional/predicate info functions
 def subtract_tzoffset_from_date(the_date):
     """Input: NSDate object
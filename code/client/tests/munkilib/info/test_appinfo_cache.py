@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_appinfo_cache.py
+
+Unit tests for info's app info cache.
+
+"""
+# Copyright 2021 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from munkilib import info
+
+
+try:
+    from mock import patch
+except ImportError:
+    import sys
+    print("mock module is required. run: easy_install mock", file=sys.stderr)
+    raise
+
+
+GOOD_ENTRY = {
+    'mtime_ns': 1600000000000000000,
+    'name': 'Firefox',
+    'bundleid': 'org.mozilla.firefox',
+    'version': '90.0',
+}
+
+
+class TestAppInfoCache(unittest.TestCase):
+    """Test loading and saving the app info cache."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.cachepath = os.path.join(
+            self.tempdir, 'Caches', 'AppInfoCache.plist')
+        patcher = patch('munkilib.info._appinfo_cache_path',
+                        return_value=self.cachepath)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_cache(self, data):
+        os.makedirs(os.path.dirname(self.cachepath))
+        with open(self.cachepath, 'wb') as fileobj:
+            if isinstance(data, bytes):
+                fileobj.write(data)
+            else:
+                plistlib.dump(data, fileobj)
+
+    def test_missing_cache(self):
+        self.assertEqual(info._load_appinfo_cache(), {})
+
+    def test_round_trip(self):
+        cache = {'/Applications/Firefox.app': GOOD_ENTRY}
+        info._save_appinfo_cache(cache)
+        self.assertEqual(info._load_appinfo_cache(), cache)
+        # no temp files left behind
+        self.assertEqual(
+            os.listdir(os.path.dirname(self.cachepath)),
+            ['AppInfoCache.plist'])
+
+    def test_unreadable_cache(self):
+        self.write_cache(b'this is not a plist')
+        self.assertEqual(info._load_appinfo_cache(), {})
+
+    def test_cache_that_is_not_a_dict(self):
+        self.write_cache([GOOD_ENTRY])
+        self.assertEqual(info._load_appinfo_cache(), {})
+
+    def test_malformed_entries_skipped(self):
+        incomplete_entry = dict(GOOD_ENTRY)
+        del incomplete_entry['version']
+        self.write_cache({
+            '/Applications/Firefox.app': GOOD_ENTRY,
+            '/Applications/String.app': 'not a dict',
+            '/Applications/Incomplete.app': incomplete_entry,
+        })
+        self.assertEqual(
+            info._load_appinfo_cache(),
+            {'/Applications/Firefox.app': GOOD_ENTRY})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_is_excluded_filesystem.py
+
+Unit tests for info.is_excluded_filesystem.
+
+"""
+# Copyright 2021 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import os
+import tempfile
+import unittest
+
+from munkilib import info
+
+
+try:
+    from mock import patch
+except ImportError:
+    import sys
+    print("mock module is required. run: easy_install mock", file=sys.stderr)
+    raise
+
+
+def filesystems_mock(mountpoint, f_flags, f_fstypename=b'apfs'):
+    """Returns a get_filesystems() result with a single filesystem"""
+    return {
+        (1, 1): {
+            'f_flags': f_flags,
+            'f_fstypename': f_fstypename,
+            'f_mntonname': os.fsencode(mountpoint),
+            'f_mntfromname': b'/dev/disk1s1',
+        },
+    }
+
+
+class TestIsExcludedFilesystem(unittest.TestCase):
+    """Test is_excluded_filesystem against a stubbed mount table."""
+
+    def setUp(self):
+        # start each test with no cached filesystem info or verdicts
+        info.FILESYSTEMS = (0, {})
+        info._UNMATCHED_DEVS.clear()
+        info._is_excluded_realpath.cache_clear()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.tempdir)
+        # the temp dir may be below /tmp or /private, which are excluded
+        # by path; keep just /Volumes so the filesystem checks are reached
+        for name, value in (('_EXCLUSION_PATHS', frozenset(['/Volumes'])),
+                            ('_EXCLUSION_PREFIXES', ('/Volumes/',))):
+            patcher = patch('munkilib.info.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        info.FILESYSTEMS = (0, {})
+        info._UNMATCHED_DEVS.clear()
+        info._is_excluded_realpath.cache_clear()
+
+    def test_local_filesystem(self):
+        with patch('munkilib.info.get_filesystems',
+                   return_value=filesystems_mock(
+                       self.tempdir, info.MNT_LOCAL)):
+            self.assertEqual(
+                info.is_excluded_filesystem(self.tempdir), False)
+
+    def test_read_only_filesystem(self):
+        with patch('munkilib.info.get_filesystems',
+                   return_value=filesystems_mock(
+                       self.tempdir, info.MNT_LOCAL | info.MNT_RDONLY)):
+            self.assertEqual(
+                info.is_excluded_filesystem(self.tempdir), True)
+
+    def test_nfs_filesystem(self):
+        with patch('munkilib.info.get_filesystems',
+                   return_value=filesystems_mock(
+                       self.tempdir, info.MNT_LOCAL, b'nfs')):
+            self.assertEqual(
+                info.is_excluded_filesystem(self.tempdir), True)
+
+    def test_exclusion_path(self):
+        with patch('munkilib.info.get_filesystems') as get_fs_mock:
+            self.assertEqual(
+                info.is_excluded_filesystem('/Volumes/Foo/Bar.app'), True)
+            self.assertFalse(get_fs_mock.called)
+
+    def test_nonexistent_path(self):
+        missing_path = os.path.join(self.tempdir, 'Missing.app')
+        with patch('munkilib.info.get_filesystems',
+                   return_value=filesystems_mock(
+                       self.tempdir, info.MNT_LOCAL)) as get_fs_mock:
+            self.assertEqual(info.is_excluded_filesystem(missing_path), None)
+            self.assertEqual(info.is_excluded_filesystem(missing_path), None)
+            # the mount table is loaded once, and not refreshed just
+            # because a path can't be stat()ed
+            self.assertEqual(get_fs_mock.call_count, 1)
+
+    def test_nonexistent_path_not_cached(self):
+        missing_path = os.path.join(self.tempdir, 'Later')
+        with patch('munkilib.info.get_filesystems',
+                   return_value=filesystems_mock(
+                       self.tempdir, info.MNT_LOCAL)):
+            self.assertEqual(info.is_excluded_filesystem(missing_path), None)
+            os.mkdir(missing_path)
+            try:
+                self.assertEqual(
+                    info.is_excluded_filesystem(missing_path), False)
+            finally:
+                os.rmdir(missing_path)
+
+    def test_unknown_filesystem(self):
+        # /dev is on a different filesystem than the temp dir
+        with patch('munkilib.info.get_filesystems',
+                   return_value=filesystems_mock(
+                       '/dev', info.MNT_LOCAL, b'devfs')) as get_fs_mock:
+            self.assertEqual(info.is_excluded_filesystem(self.tempdir), None)
+            self.assertEqual(info.is_excluded_filesystem(self.tempdir), None)
+            # one load, and one retry in case the stat() triggered an
+            # automount; not a refresh per call
+            self.assertEqual(get_fs_mock.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
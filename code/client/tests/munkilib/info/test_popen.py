@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_popen.py
+
+Unit tests for info.Popen's timeout handling.
+
+"""
+# Copyright 2021 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import time
+import unittest
+
+from munkilib import info
+
+
+def reap(proc):
+    """Kills proc if it is still running and closes its pipes"""
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    for fileobj in (proc.stdin, proc.stdout, proc.stderr):
+        if fileobj is not None:
+            fileobj.close()
+
+
+class TestPopenCommunicate(unittest.TestCase):
+    """Test info.Popen.communicate with an inactivity timeout."""
+
+    def run_cmd(self, script, timeout):
+        proc = info.spawn(['/bin/sh', '-c', script])
+        self.addCleanup(reap, proc)
+        return proc.communicate(timeout=timeout)
+
+    def test_output_and_exit(self):
+        output, error = self.run_cmd('echo out; echo err >&2', 5)
+        self.assertEqual(output, b'out\n')
+        self.assertEqual(error, b'err\n')
+
+    def test_inactivity_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(info.TimeoutError):
+            self.run_cmd('sleep 30', 1)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_output_after_a_wait(self):
+        output, dummy_error = self.run_cmd('sleep 2; echo done', 5)
+        self.assertEqual(output, b'done\n')
+
+    def test_output_resets_timeout(self):
+        # never idle for 2 seconds, but runs for longer than that
+        output, dummy_error = self.run_cmd(
+            'for i in 1 2 3 4; do echo $i; sleep 1; done', 2)
+        self.assertEqual(output, b'1\n2\n3\n4\n')
+
+    def test_child_closes_pipes_but_keeps_running(self):
+        start = time.monotonic()
+        with self.assertRaises(info.TimeoutError):
+            self.run_cmd('exec >&- 2>&-; sleep 30', 1)
+        self.assertLess(time.monotonic() - start, 10)
+
+
+class TestPopenTimedReadline(unittest.TestCase):
+    """Test info.Popen.timed_readline."""
+
+    def spawn(self, script):
+        proc = info.spawn(['/bin/sh', '-c', script])
+        self.addCleanup(reap, proc)
+        return proc
+
+    def test_lines_from_one_read(self):
+        proc = self.spawn('printf "one\\ntwo\\nthree"')
+        self.assertEqual(proc.timed_readline(proc.stdout, 5), b'one\n')
+        self.assertEqual(proc.timed_readline(proc.stdout, 5), b'two\n')
+        # EOF returns what's left, then nothing
+        self.assertEqual(proc.timed_readline(proc.stdout, 5), b'three')
+        self.assertEqual(proc.timed_readline(proc.stdout, 5), b'')
+
+    def test_partial_line_carried_over(self):
+        proc = self.spawn('printf "one\\ntw"; sleep 3; printf "o\\n"')
+        self.assertEqual(proc.timed_readline(proc.stdout, 5), b'one\n')
+        with self.assertRaises(info.TimeoutError):
+            proc.timed_readline(proc.stdout, 1)
+        # the partial line read before the timeout isn't lost
+        self.assertEqual(proc.timed_readline(proc.stdout, 5), b'two\n')
+
+
+if __name__ == '__main__':
+    unittest.main()